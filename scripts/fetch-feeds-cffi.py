@@ -2,137 +2,73 @@
 """
 Fetches Perplexity Discover stories using curl_cffi (Chrome TLS impersonation)
 to bypass Cloudflare bot detection. Writes perplexity_cache.json.
+
+Only the transport lives here; story building and the cache write are shared
+with update_discover.py.
 """
 
+import asyncio
 import json
 import sys
-from collections import Counter
-from datetime import datetime, timezone
-from pathlib import Path
+import time
 
-from curl_cffi import requests
+from curl_cffi import CurlOpt, requests
 
-API_BASE = "https://www.perplexity.ai/rest/discover/feed"
-TOPICS = [
-    {"tab": "top", "limit": 150},
-    {"tab": "tech", "limit": 50},
-    {"tab": "finance", "limit": 50},
-]
-MIN_STORIES = 30
+from update_discover import (
+    API_BASE,
+    MAX_ATTEMPTS,
+    REQUEST_TIMEOUT,
+    RETRY_BUDGET,
+    TOPICS,
+    backoff_delay,
+    collect_stories,
+    is_retryable_status,
+    run_timeout,
+    update_cache,
+)
 
 
-def fetch_topic(tab, limit):
+async def fetch_topic(session, tab, limit):
     url = f"{API_BASE}?tab={tab}&limit={limit}"
     print(f"Fetching {url} ...")
-    try:
-        resp = requests.get(url, impersonate="chrome", timeout=30)
-        if resp.status_code != 200:
-            print(f"  Error {resp.status_code} for {tab}")
+    deadline = time.monotonic() + RETRY_BUDGET
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            resp = await session.get(url, timeout=REQUEST_TIMEOUT)
+            if resp.status_code == 200:
+                data = json.loads(resp.text)
+                items = data.get("items", [])
+                print(f"  Got {len(items)} items for {tab}")
+                return items
+            print(f"  Error {resp.status_code} for {tab} (attempt {attempt}/{MAX_ATTEMPTS})")
+            if not is_retryable_status(resp.status_code):
+                return []
+        except Exception as e:
+            print(f"  Error fetching {tab} (attempt {attempt}/{MAX_ATTEMPTS}): {e}", file=sys.stderr)
+        delay = backoff_delay(attempt)
+        if attempt == MAX_ATTEMPTS or time.monotonic() + delay >= deadline:
             return []
-        data = json.loads(resp.text)
-        items = data.get("items", [])
-        print(f"  Got {len(items)} items for {tab}")
-        return items
-    except Exception as e:
-        print(f"  Error fetching {tab}: {e}", file=sys.stderr)
-        return []
-
-
-def build_story(item, topic):
-    title = (item.get("title") or "").strip()
-    if not title:
-        return None
-
-    slug = item.get("slug", "")
-    uuid = item.get("uuid", "")
-    url = f"https://www.perplexity.ai/page/{slug}" if slug else ""
-    if not url and uuid:
-        url = f"https://www.perplexity.ai/page/{uuid}"
-    if not url:
-        return None
+        await asyncio.sleep(delay)
 
-    pub_date = item.get("published_timestamp") or item.get("updated_datetime") or ""
-    if pub_date:
-        pub_date = pub_date.split(".")[0]
-        if not pub_date.endswith("Z"):
-            pub_date = pub_date.replace("+00:00", "") + "Z"
 
-    source_count = ""
-    preview = item.get("web_results_preview")
-    if isinstance(preview, dict):
-        total = preview.get("total_count", 0)
-        if total:
-            source_count = f"{total} sources"
-
-    description = (item.get("summary") or item.get("first_answer") or "").strip()
-
-    return {
-        "title": title,
-        "url": url,
-        "description": description,
-        "source": "Perplexity",
-        "topic": topic,
-        "pubDate": pub_date,
-        "sourceCount": source_count,
-    }
+async def fetch_all_topics():
+    # One session for all topics. Concurrent requests only share a connection
+    # if curl waits for it to be established and multiplexes onto it; without
+    # PIPEWAIT each gathered request opens its own connection and handshake.
+    session = requests.AsyncSession(
+        impersonate="chrome", curl_options={CurlOpt.PIPEWAIT: 1}
+    )
+    async with session:
+        return await asyncio.gather(
+            *(fetch_topic(session, cfg["tab"], cfg["limit"]) for cfg in TOPICS)
+        )
 
 
 def main():
-    cache_path = Path("perplexity_cache.json")
-
-    existing_count = 0
-    if cache_path.exists():
-        try:
-            with open(cache_path) as f:
-                existing = json.load(f)
-            existing_count = len(existing.get("stories", []))
-        except Exception:
-            pass
-
-    stories = []
-    seen_urls = set()
-    for topic_cfg in TOPICS:
-        tab = topic_cfg["tab"]
-        items = fetch_topic(tab, topic_cfg["limit"])
-        for item in items:
-            story = build_story(item, tab)
-            if story and story["url"] not in seen_urls:
-                seen_urls.add(story["url"])
-                stories.append(story)
-        print(f"  Total for {tab}: {len([s for s in stories if s['topic'] == tab])}")
-
-    topic_counts = Counter(s["topic"] for s in stories)
-    print(f"Fetched: {len(stories)} stories — {dict(topic_counts)}")
-    print(f"Existing cache: {existing_count} stories")
-
-    if not stories:
-        print("No stories fetched. Keeping existing cache.", file=sys.stderr)
-        sys.exit(0)
-
-    if len(stories) < MIN_STORIES:
-        print(f"Only {len(stories)} stories (need {MIN_STORIES}+). Keeping cache.", file=sys.stderr)
-        sys.exit(0)
-
-    if existing_count > 0 and len(stories) < existing_count * 0.5:
-        print(f"New ({len(stories)}) < half of existing ({existing_count}). Keeping cache.", file=sys.stderr)
-        sys.exit(0)
-
-    topics = {"top": [], "tech": [], "finance": []}
-    for s in stories:
-        t = s.get("topic", "top")
-        if t in topics:
-            topics[t].append(s)
-
-    cache = {
-        "stories": stories,
-        "cached_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "topics": topics,
-    }
-
-    with open(cache_path, "w") as f:
-        json.dump(cache, f, indent=2, ensure_ascii=False)
-
-    print(f"Wrote {len(stories)} stories to perplexity_cache.json")
+    with run_timeout():
+        results = asyncio.run(fetch_all_topics())
+    stories, topics = collect_stories(results)
+    update_cache(stories, topics)
 
 
 if __name__ == "__main__":
@@ -6,15 +6,32 @@ Runs via GitHub Actions on a schedule. Uses the REST API (no browser needed).
 Two modes:
   python update_discover.py                   # fetch directly via urllib
   python update_discover.py --from-curl DIR   # read pre-fetched JSON files from DIR
+
+Story building and cache writing live here; fetch-feeds-cffi.py reuses them
+with a curl_cffi transport.
 """
 
+import gzip
+import hashlib
 import json
+import os
+import random
+import signal
 import sys
+import time
+import urllib.error
 import urllib.request
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # optional; only speeds up the cache write
+    orjson = None
+
 API_BASE = "https://www.perplexity.ai/rest/discover/feed"
 
 TOPICS = [
@@ -23,31 +40,102 @@ TOPICS = [
     {"tab": "finance", "limit": 50},
 ]
 
+CACHE_PATH = Path("perplexity_cache.json")
+
 # Minimum stories required to overwrite cache.
 MIN_STORIES_TO_WRITE = 30
 
+# Request timeout in seconds. curl_cffi applies it to the whole request;
+# urllib applies it to each connect and socket read, so a slowly trickling
+# response can outlast it. RUN_TIMEOUT bounds the total either way.
+REQUEST_TIMEOUT = 20
+
+# Retry policy for feed requests. Attempts stop at MAX_ATTEMPTS or once the
+# next backoff would cross RETRY_BUDGET seconds from the first attempt. The
+# budget is only checked between attempts, so it doesn't bound a request
+# that is already in flight; RUN_TIMEOUT does.
+MAX_ATTEMPTS = 3
+RETRY_BUDGET = 30
+
+# Hard wall-clock cap, in seconds, on fetching all topics. Well inside the
+# workflow's five-minute timeout, and the only bound when refresh-cache.sh
+# runs this from launchd.
+RUN_TIMEOUT = 120
+
+REQUEST_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/124.0.0.0 Safari/537.36"
+    ),
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Language": "en-US,en;q=0.9",
+    # urllib doesn't negotiate compression on its own; the feed JSON
+    # shrinks by roughly 5x gzipped.
+    "Accept-Encoding": "gzip",
+}
+
+
+def is_retryable_status(status):
+    """Rate limits and server errors are worth retrying; other 4xx are not."""
+    return status == 429 or status >= 500
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: up to 0.5s, 1s, 2s, ... capped at 4s."""
+    return random.uniform(0, min(4.0, 0.5 * 2 ** (attempt - 1)))
+
+
+@contextmanager
+def run_timeout(seconds=RUN_TIMEOUT):
+    """Exit the process if the enclosed fetch runs longer than ``seconds``.
+
+    Only wrap fetching: the cache write must not be cut off mid-way.
+    """
+    def abort(signum, frame):
+        print(f"Fetch exceeded {seconds}s. Keeping existing cache.", file=sys.stderr)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Worker threads stuck in a socket read can't be interrupted, and a
+        # normal exit would wait on them, so leave immediately.
+        os._exit(1)
+
+    previous = signal.signal(signal.SIGALRM, abort)
+    signal.alarm(seconds)
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
 
 def fetch_topic_api(tab, limit):
     """Fetch stories for a single topic from the REST API."""
     url = f"{API_BASE}?tab={tab}&limit={limit}"
     print(f"Fetching {url} ...")
 
-    req = urllib.request.Request(url, headers={
-        "User-Agent": (
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/124.0.0.0 Safari/537.36"
-        ),
-        "Accept": "application/json, text/plain, */*",
-        "Accept-Language": "en-US,en;q=0.9",
-    })
+    req = urllib.request.Request(url, headers=REQUEST_HEADERS)
 
-    try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            data = json.loads(resp.read().decode())
-    except Exception as e:
-        print(f"  Error fetching {tab}: {e}", file=sys.stderr)
-        return []
+    deadline = time.monotonic() + RETRY_BUDGET
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as resp:
+                body = resp.read()
+                if resp.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                data = json.loads(body.decode())
+            break
+        except Exception as e:
+            print(
+                f"  Error fetching {tab} (attempt {attempt}/{MAX_ATTEMPTS}): {e}",
+                file=sys.stderr,
+            )
+            if isinstance(e, urllib.error.HTTPError) and not is_retryable_status(e.code):
+                return []
+            delay = backoff_delay(attempt)
+            if attempt == MAX_ATTEMPTS or time.monotonic() + delay >= deadline:
+                return []
+            time.sleep(delay)
 
     items = data.get("items", [])
     print(f"  Got {len(items)} items for {tab}")
@@ -116,57 +204,86 @@ def build_story(item, topic):
     }
 
 
-def fetch_discover_stories(curl_dir=None):
+def canonical_url(url):
+    """Dedup key for a story URL: drop any query string and trailing slash."""
+    return url.split("?", 1)[0].rstrip("/")
+
+
+def stories_digest(stories):
+    """Hash the ordered (url, title) list so unchanged fetches can be skipped."""
+    key = json.dumps([(s["url"], s["title"]) for s in stories])
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def collect_stories(results):
+    """Build, dedup and group stories from per-topic item lists.
+
+    ``results`` holds one list of raw API items per entry in TOPICS, in the
+    same order. Returns ``(stories, topics)``.
+    """
+    # The same story is often listed under several tabs; keep the first
+    # (highest-priority topic) occurrence only.
     stories = []
-    for topic_cfg in TOPICS:
+    topics = {cfg["tab"]: [] for cfg in TOPICS}
+    seen_urls = set()
+    for topic_cfg, items in zip(TOPICS, results):
         tab = topic_cfg["tab"]
+        # The API is asked for at most `limit` items, but pre-fetched files
+        # (and the API, if it ignores the parameter) can hold more.
+        built = (build_story(item, tab) for item in items[:topic_cfg["limit"]])
+        fresh = topics[tab]
+        for story in filter(None, built):
+            key = canonical_url(story["url"])
+            if key not in seen_urls:
+                seen_urls.add(key)
+                fresh.append(story)
+        stories.extend(fresh)
 
-        if curl_dir:
-            items = fetch_topic_file(tab, curl_dir)
-        else:
-            items = fetch_topic_api(tab, topic_cfg["limit"])
+    return stories, topics
 
-        for item in items:
-            story = build_story(item, tab)
-            if story:
-                stories.append(story)
 
-        count = len([s for s in stories if s["topic"] == tab])
-        print(f"  Total for {tab}: {count}")
+def fetch_discover_stories(curl_dir=None):
+    if curl_dir:
+        results = [fetch_topic_file(cfg["tab"], curl_dir) for cfg in TOPICS]
+    else:
+        # Topics are independent requests, so fetch them concurrently:
+        # wall time is the slowest topic rather than the sum of all three.
+        with ThreadPoolExecutor(max_workers=len(TOPICS)) as pool:
+            results = list(pool.map(
+                lambda cfg: fetch_topic_api(cfg["tab"], cfg["limit"]), TOPICS
+            ))
 
-    return stories
+    return collect_stories(results)
 
 
-def main():
-    cache_path = Path("perplexity_cache.json")
+def dump_cache(cache):
+    """Serialize the cache as indented UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(cache, option=orjson.OPT_INDENT_2)
+    return json.dumps(cache, indent=2, ensure_ascii=False).encode()
 
-    # Check for --from-curl mode
-    curl_dir = None
-    if "--from-curl" in sys.argv:
-        idx = sys.argv.index("--from-curl")
-        if idx + 1 < len(sys.argv):
-            curl_dir = sys.argv[idx + 1]
-            print(f"Reading pre-fetched data from {curl_dir}")
 
+def update_cache(stories, topics, cache_path=CACHE_PATH):
+    """Write stories to the cache unless the fetch looks worse or unchanged."""
     # Load existing cache to compare
     existing_count = 0
+    existing_digest = None
     if cache_path.exists():
         try:
             with open(cache_path) as f:
                 existing = json.load(f)
             existing_count = len(existing.get("stories", []))
+            existing_digest = existing.get("digest")
         except Exception:
             pass
 
-    stories = fetch_discover_stories(curl_dir)
-
     topic_counts = Counter(s["topic"] for s in stories)
     print(f"Fetched: {len(stories)} stories — {dict(topic_counts)}")
     print(f"Existing cache: {existing_count} stories")
 
     if not stories:
         print("No stories fetched. Keeping existing cache.", file=sys.stderr)
-        sys.exit(0)
+        return False
 
     # SAFETY: Don't overwrite a good cache with a worse fetch
     if len(stories) < MIN_STORIES_TO_WRITE:
@@ -175,7 +292,7 @@ def main():
             f"Keeping existing cache with {existing_count} stories.",
             file=sys.stderr,
         )
-        sys.exit(0)
+        return False
 
     if existing_count > 0 and len(stories) < existing_count * 0.5:
         print(
@@ -183,25 +300,51 @@ def main():
             f"({existing_count}). Keeping existing cache.",
             file=sys.stderr,
         )
-        sys.exit(0)
+        return False
 
-    # Build the cache
-    topics = {"top": [], "tech": [], "finance": []}
-    for s in stories:
-        t = s.get("topic", "top")
-        if t in topics:
-            topics[t].append(s)
+    # Rewriting an unchanged feed would only bump cached_at and produce a
+    # commit (and redeploy) with no new stories in it.
+    digest = stories_digest(stories)
+    if digest == existing_digest:
+        print(
+            "Stories unchanged since last fetch. Keeping existing cache.",
+            file=sys.stderr,
+        )
+        return False
 
     cache = {
         "stories": stories,
         "cached_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
         "topics": topics,
+        "digest": digest,
     }
 
-    with open(cache_path, "w") as f:
-        json.dump(cache, f, indent=2, ensure_ascii=False)
+    # Write to a sibling temp file and rename over the cache, so a reader
+    # never sees a half-written file.
+    tmp_path = cache_path.with_suffix(".json.tmp")
+    try:
+        tmp_path.write_bytes(dump_cache(cache))
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    print(f"Wrote {len(stories)} stories to {cache_path}")
+    return True
+
+
+def main():
+    # Check for --from-curl mode
+    curl_dir = None
+    if "--from-curl" in sys.argv:
+        idx = sys.argv.index("--from-curl")
+        if idx + 1 < len(sys.argv):
+            curl_dir = sys.argv[idx + 1]
+            print(f"Reading pre-fetched data from {curl_dir}")
 
-    print(f"Wrote {len(stories)} stories to perplexity_cache.json")
+    with run_timeout():
+        stories, topics = fetch_discover_stories(curl_dir)
+    update_cache(stories, topics)
 
 
 if __name__ == "__main__":